@@ -19,19 +19,42 @@
 from requests.compat import urlunparse, urlparse
 from . import __version__ as version
 
+import functools
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 import warnings
-from .exceptions import ResourceNotFound, TransportError, Unauthorized, ServerWarning, NotBootstrapped, AlreadyBootstrapped
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    from time import time as monotonic
+try:
+    import orjson  # Optional, faster JSON serialization for request bodies
+except ImportError:
+    orjson = None
+from .exceptions import BatchRejected, ResourceNotFound, TransportError, Unauthorized, ServerWarning, NotBootstrapped, AlreadyBootstrapped
 
 from .models import Server
 
 logger = logging.getLogger(__name__)
 APIV1 = '/api/v1'
+SESSION_EXPIRY_MARGIN = 30  # Seconds before a session's TTL runs out that it's considered expired
+SERVER_TIMEOUT_MARGIN = 30  # Seconds the client waits beyond a server-side `timeout` parameter before giving up
+URL_CACHE_SIZE = 256  # Distinct paths remembered per Connection before the cache is reset
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Pooled adapters shared by every Connection to the same server; see Connection.__init__.
+_adapters = {}
+_adapters_lock = threading.Lock()
+
+
+DEFAULT_USER_AGENT = "pyloginsight/{0}".format(version)
 
 
 def default_user_agent():
-    return "pyloginsight/{0}".format(version)
+    return DEFAULT_USER_AGENT
 
 
 class Credentials(requests.auth.AuthBase):
@@ -45,56 +68,79 @@ class Credentials(requests.auth.AuthBase):
         self.provider = provider
         self.sessionId = sessionId  # An existing session id, like "hNhXgAM1xrl..."
         self.requests_session = reuse_session or requests.Session()
+        self._expires_at = None  # monotonic() time after which sessionId shouldn't be used, if the TTL is known
+        self._auth_lock = threading.Lock()
 
-    def get_session(self, previousresponse, **kwargs):
-        """Perform a session login and return a new session ID."""
+    @property
+    def sessionId(self):
+        return self._sessionId
+
+    @sessionId.setter
+    def sessionId(self, value):
+        self._sessionId = value
+        self._auth_header = "Bearer %s" % value if value else None  # Built once per session, not per request
+
+    def get_session(self, previousresponse, sessions_url=None, requests_session=None, **kwargs):
+        """Perform a session login to the server that sent `previousresponse`, and return a new session ID.
+        Pass that server's `sessions_url`, if known, to avoid deriving it from the previous request's URL, and the
+        `requests_session` the request went through to log in through it rather than straight through its adapter."""
+        if sessions_url is None:
+            p = urlparse(previousresponse.request.url)
+            sessions_url = urlunparse([p.scheme, p.netloc, APIV1 + "/sessions", None, None, None])
+        send = previousresponse.connection.send if requests_session is None else requests_session.send
+        return self._login(sessions_url, send, **kwargs)  # kwargs contains ssl _verify
+
+    def _login(self, url, send, **kwargs):
+        """Log in at the /sessions `url`, sending the login with `send`. Return a new session ID."""
         if self.username is None or self.password is None:
             raise Unauthorized("Cannot authenticate without username/password")
-        logger.info("Attempting to authenticate as {0}".format(self.username))
+        logger.info("Attempting to authenticate as %s", self.username)
         authdict = {"username": self.username, "password": self.password, "provider": self.provider}
 
-        prep = previousresponse.request.copy()
-        try:
-            del prep.headers['Authorization']
-        except KeyError:
-            pass  # Better to ask for forgiveness than to look before you leap
-        if 'Authorization' in prep.headers:
-            del prep.headers['Authorization']
-
-        prep.prepare_method("post")
-        p = urlparse(previousresponse.request.url)
-        prep.prepare_url(urlunparse([p.scheme,
-                                     p.netloc,
-                                     APIV1 + "/sessions",
-                                     None,
-                                     None,
-                                     None]), params=None)
-
-        logger.debug("Authenticating via url: {0}".format(prep.url))
-        prep.prepare_body(data=None, files=None, json=authdict)
-        authresponse = previousresponse.connection.send(prep, **kwargs)  # kwargs contains ssl _verify
+        # A fresh request, rather than a copy of the previous one, carries none of its headers or hooks.
+        prep = self.requests_session.prepare_request(requests.Request("POST", url, json=authdict))
+        logger.debug("Authenticating via url: %s", prep.url)
+        return self._session_from_response(send(prep, **kwargs))
+
+    def _session_from_response(self, authresponse):
         try:
-            return authresponse.json()['sessionId']
+            body = authresponse.json()
+            sessionId = body['sessionId']
         except:
             if authresponse.status_code == 503 and 'should be bootstrapped' in authresponse.json().get('errorMessage', ''):
                 raise NotBootstrapped(authresponse.json().get('errorMessage'), authresponse)
             raise Unauthorized("Authentication failed", authresponse)
+        ttl = body.get('ttl')
+        self._expires_at = None if ttl is None else monotonic() + max(0, ttl - SESSION_EXPIRY_MARGIN)
+        return sessionId
+
+    def _needs_session(self):
+        """True if a request would be refused for lack of a current session."""
+        return not self.sessionId or (self._expires_at is not None and monotonic() >= self._expires_at)
 
-    def handle_401(self, r, **kwargs):
-        # method signature matches requests.Request.register_hook
+    def handle_401(self, r, sessions_url=None, requests_session=None, **kwargs):
+        # method signature matches requests.Request.register_hook, plus the refusing server's sessions_url and
+        # requests_session if known
 
         if r.status_code not in [401, 440]:
             return r
 
-        logger.debug("Not authenticated (got status {r.status_code} @ {r.request.url})".format(r=r))
-        r.content  # Drain previous response body, if any
+        logger.debug("Not authenticated (got status %s @ %s)", r.status_code, r.request.url)
+        try:
+            r.raw.drain_conn()  # Discard the body without keeping a copy, returning the connection to the pool
+        except AttributeError:  # urllib3 before 1.26
+            r.content  # Drain previous response body, if any
         r.close()
 
-        self.sessionId = self.get_session(r, **kwargs)
+        refused = r.request.headers.get("Authorization")
+        with self._auth_lock:
+            # If another thread logged in after this request was sent, retry with its session instead of logging in again.
+            if refused == self._auth_header or not self.sessionId:
+                self.sessionId = self.get_session(r, sessions_url=sessions_url, requests_session=requests_session, **kwargs)
 
         # Now that we have a good session, copy and retry the original request. If it fails again, raise Unauthorized.
         prep = r.request.copy()
-        prep.headers.update({"Authorization": "Bearer %s" % self.sessionId})
+        prep.headers["Authorization"] = self._auth_header
         _r = r.connection.send(prep, **kwargs)
         _r.history.append(r)
         _r.request = prep
@@ -104,42 +150,79 @@ class Credentials(requests.auth.AuthBase):
         logger.debug("Authenticated successfully.")
         return _r
 
-    def __call__(self, r):
-        if self.sessionId:
+    def authorize(self, r, requests_session=None, sessions_url=None, **send_kwargs):
+        """Add authorization to the request `r`, which will be sent through `requests_session` with `send_kwargs`.
+        `sessions_url` is the /sessions URL of the server `r` is sent to. Given both, and if the request would be refused
+        for lack of a current session, log in through the session first."""
+        if requests_session is not None and sessions_url is not None and self.username is not None and self.password is not None and self._needs_session():
+            # Without a current Session ID Bearer Token this request would fail with 401, so log in first.
+            with self._auth_lock:
+                if self._needs_session():  # Another thread may have logged in while we waited
+                    self.sessionId = self._login(sessions_url, requests_session.send, **send_kwargs)
+
+        auth_header = self._auth_header
+        if auth_header:
             # If we already have a Session ID Bearer Token, try to use it.
-            r.headers.update({"Authorization": "Bearer %s" % self.sessionId})
-
-        # TODO: If the TTL has expired, or we have no Bearer token at all, we can reasonably expect this
-        # TODO.cont: request to fail with 401. In both cases, we could avoid a round-trip to the server.
-        # TODO.cont: This is an optimization and does not materially affect success.
+            r.headers["Authorization"] = auth_header
 
         # Attempt the request. If it fails with a 401, generate a new sessionId
-        r.register_hook('response', self.handle_401)
+        if sessions_url is None:
+            r.register_hook('response', self.handle_401)
+        else:
+            r.register_hook('response', functools.partial(self.handle_401, sessions_url=sessions_url, requests_session=requests_session))
         return r
 
+    def __call__(self, r):
+        return self.authorize(r)
+
     def __repr__(self):
-        return '{cls}(username={x.username!r}, password=..., provider={x.provider!r})'.format(cls=self.__class__.__name__, x=self)
+        return '%s(username=%r, password=..., provider=%r)' % (self.__class__.__name__, self.username, self.provider)
 
 
 class Connection(object):
     """Low-level HTTP transport connecting to a remote Log Insight server's API.
     Attempts requests to the server which require authentication. If requests fail with HTTP 401 Unauthorized,
     obtains a session bearer token and retries the request.
-    You should probably use the :py:class:: Server class instead"""
+    You should probably use the :py:class:: Server class instead
 
-    def __init__(self, hostname, port=9543, ssl=True, verify=True, auth=None, existing_session=None):
-        self._requestsession = existing_session or requests.Session()
+    Connections to the same server (and with the same verify and pool_maxsize) share one pool of keep-alive connections,
+    which stays open for the life of the process. Use :py:meth:`close`, rather than closing the requests session itself,
+    to release a connection without closing that shared pool for every other Connection."""
+
+    def __init__(self, hostname, port=9543, ssl=True, verify=True, auth=None, existing_session=None, pool_maxsize=10,
+                 timeout=(5, 60)):
         self._hostname = hostname
         self._port = port
         self._ssl = ssl
         self._verify = verify
         self._authprovider = auth
+        self._pool_maxsize = pool_maxsize
+        self._timeout = timeout  # (connect, read) seconds; a stalled server must not hold a pooled connection forever
+
+        prefix = '{method}://{hostname}:{port}'.format(method='https' if ssl else 'http', hostname=hostname, port=port)
+        self._apiroot = prefix + APIV1
+        self._url_cache = {}
+
+        if existing_session is None:
+            # All requests to this server share one pool of keep-alive connections. Block, rather than open and
+            # discard extra connections, when more than pool_maxsize requests are in flight at once.
+            # The requests session (headers, cookies) belongs to this Connection, but the adapter holding the pool is
+            # shared with every other Connection to the same server.
+            key = (prefix, verify, pool_maxsize)
+            with _adapters_lock:
+                adapter = _adapters.get(key)
+                if adapter is None:
+                    adapter = _adapters[key] = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+            self._requestsession = requests.Session()
+            self._requestsession.mount(prefix, adapter)
+        else:
+            self._requestsession = existing_session
+        # Each request passes its own auth explicitly. With no fallback on the session, requests made with
+        # sendauthorization=False really are sent without authorization.
+        self._requestsession.auth = None
 
-        self._apiroot = '{method}://{hostname}:{port}{apiv1}'.format(method='https' if ssl else 'http',
-                                                                     hostname=hostname, port=port, apiv1=APIV1)
-
-        self._requestsession.headers.update({'User-Agent': default_user_agent()})
-        logger.debug("Connected to {0}".format(self))
+        self._requestsession.headers.update({'User-Agent': DEFAULT_USER_AGENT})
+        logger.debug("Connected to %s", self)
 
     @classmethod
     def copy_connection(cls, connection):
@@ -149,26 +232,91 @@ class Connection(object):
                    ssl=connection._ssl,
                    verify=connection._verify,
                    auth=connection._authprovider,
-                   existing_session=connection._requestsession)
-
-    def _call(self, method, url, data=None, json=None, params=None, sendauthorization=True):
-        logger.debug("{} {} data={} json={} params={}".format(method, url, data, json, params))
-
-        r = self._requestsession.request(method=method,
-                                         url="%s%s" % (self._apiroot, url),
+                   existing_session=connection._requestsession,
+                   pool_maxsize=connection._pool_maxsize,
+                   timeout=connection._timeout)
+
+    def close(self):
+        """Close this connection's requests session, leaving the connection pool it shares with other Connections open."""
+        # The session may have come from another Connection, e.g. through copy_connection, and hold its shared adapter
+        with _adapters_lock:
+            shared = list(_adapters.values())
+        adapters = self._requestsession.adapters
+        for prefix in [prefix for prefix, adapter in adapters.items() if any(adapter is a for a in shared)]:
+            del adapters[prefix]
+        self._requestsession.close()
+
+    def _url(self, path):
+        """Absolute URL for an API path, like `/version`. Frequently-used paths are remembered."""
+        url = self._url_cache.get(path)
+        if url is None:
+            if len(self._url_cache) >= URL_CACHE_SIZE:
+                self._url_cache.clear()  # Paths containing ids or queries are unbounded; don't grow forever
+            url = self._url_cache[path] = self._apiroot + path
+        return url
+
+    def _authorize(self, r):
+        """Authorize a request with this connection's credentials. Credentials that need a session log in through this
+        connection, with its settings, so one Credentials object can be shared by connections to different servers."""
+        auth = self._authprovider
+        if isinstance(auth, Credentials):
+            return auth.authorize(r, self._requestsession, self._url('/sessions'), verify=self._verify, timeout=self._timeout)
+        return auth(r)
+
+    def _timeout_for(self, params):
+        """The connection's default timeout, with the read timeout extended beyond any server-side `timeout` parameter
+        (in milliseconds, like a query's), so the client doesn't give up before the server has used its budget."""
+        timeout = self._timeout
+        server_timeout = params.get('timeout') if isinstance(params, dict) else None
+        if server_timeout is None:
+            return timeout
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        if read is None:
+            return timeout
+        return connect, max(read, float(server_timeout) / 1000 + SERVER_TIMEOUT_MARGIN)
+
+    def _request(self, method, url, data=None, json=None, params=None, sendauthorization=True, timeout=None, stream=False):
+        """Send a single request to the server and return the :py:class:`requests.Response`, without interpreting it.
+        A `timeout` overrides the connection's default for this request only.
+        With `stream=True` the body isn't read up-front; consume it with `r.iter_content()`, then `r.close()`."""
+        headers = None
+        if json is not None and data is None and orjson is not None:
+            # Hand datetimes and dataclasses back, as the standard library json module would refuse them. orjson still
+            # differs in sending UUIDs and Enums by value and NaN or infinite floats as null, where requests raises.
+            try:
+                data = orjson.dumps(json, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS)
+                json, headers = None, JSON_HEADERS
+            except TypeError:
+                pass  # Something orjson won't serialize, like a non-str dict key; leave it to requests
+        r = self._requestsession.request(method,
+                                         self._url(url),
                                          data=data,
                                          json=json,
+                                         params=params,
+                                         headers=headers,
                                          verify=self._verify,
-                                         auth=self._authprovider if sendauthorization else None,
-                                         params=params)
-
-        if 'Warning' in r.headers:
-            if 'VMware-LI-API-Status' in r.headers:
-                warnings.warn("Log Insight API resource {} {} is {}".format(method, url, r.headers['VMware-LI-API-Status']),
+                                         auth=self._authorize if sendauthorization and self._authprovider is not None else None,
+                                         timeout=timeout or self._timeout_for(params),
+                                         stream=stream)
+
+        warning = r.headers.get('Warning')
+        if warning:
+            api_status = r.headers.get('VMware-LI-API-Status')
+            if api_status:
+                warnings.warn("Log Insight API resource {} {} is {}".format(method, url, api_status),
                               ServerWarning,
-                              stacklevel=5)
+                              stacklevel=6)
             else:
-                warnings.warn(r.headers.get('Warning'))
+                warnings.warn(warning)
+        return r
+
+    def _call(self, method, url, data=None, json=None, params=None, sendauthorization=True, timeout=None):
+        logger.debug("%s %s data=%s json=%s params=%s", method, url, data, json, params)
+
+        try:
+            r = self._request(method, url, data=data, json=json, params=params, sendauthorization=sendauthorization, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            raise TransportError("{} {} timed out: {}".format(method, url, e), request=e.request)
 
         try:
             payload = r.json()
@@ -189,7 +337,7 @@ class Connection(object):
                 return True
         """
 
-        logger.debug("{} {}: status_code[{}]: {}".format(method, url, r.status_code, payload))
+        logger.debug("%s %s: status_code[%s]: %s", method, url, r.status_code, payload)
 
         # Success
         if 200 <= r.status_code < 300:
@@ -232,6 +380,22 @@ class Connection(object):
                           sendauthorization=sendauthorization,
                           params=params)
 
+    def get_many(self, urls, params=None, sendauthorization=True):
+        """
+        GET several urls at once, over up to `pool_maxsize` pooled connections, rather than one after another.
+        :return: A list of payloads, in the same order as `urls`. If any request fails, its exception is raised.
+        """
+        urls = list(urls)
+        if len(urls) <= 1:
+            return [self.get(url, params=params, sendauthorization=sendauthorization) for url in urls]
+
+        pool = ThreadPool(min(self._pool_maxsize, len(urls)))
+        try:
+            return pool.map(lambda url: self.get(url, params=params, sendauthorization=sendauthorization), urls)
+        finally:
+            pool.close()
+            pool.join()
+
     def delete(self, url, params=None, sendauthorization=True):
         return self._call(method="DELETE",
                           url=url,
@@ -256,9 +420,51 @@ class Connection(object):
                           sendauthorization=sendauthorization,
                           params=params)
 
+    def _post_batch(self, url, items, chunk_size=500, json_key='events', sendauthorization=True):
+        """
+        POST `items` in as few requests as possible, as `{json_key: [item, ...]}` with up to `chunk_size` items each.
+        If the server rejects a chunk with a 4xx status, its items are sent again one at a time, so one bad item doesn't
+        lose the others. Server errors and timeouts are raised straight away.
+        Every item is sent before the items the server still rejects are raised together, as :py:class:`BatchRejected`.
+        :return: A list with the payload of each successful request.
+        """
+        items = list(items)
+        payloads = []
+        failures = []
+
+        def post(chunk):
+            try:
+                payloads.append(self.post(url, json={json_key: chunk}, sendauthorization=sendauthorization))
+            except (Unauthorized, ResourceNotFound):
+                raise  # Not a problem with the items; retrying them individually would fail the same way
+            except (ValueError, TransportError) as e:
+                status = e.args[0] if e.args else None
+                if isinstance(status, int) and 400 <= status < 500:
+                    return e  # The server refused the chunk's content
+                raise  # A server fault or timeout; sending each item separately would only add load
+
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            error = post(chunk)
+            if error is None:
+                continue
+            if len(chunk) == 1:
+                failures.append((chunk[0], error))
+                continue
+            logger.debug("POST %s rejected a chunk of %d items, retrying them individually", url, len(chunk))
+            for item in chunk:
+                error = post([item])
+                if error is not None:
+                    failures.append((item, error))
+
+        if failures:
+            raise BatchRejected(failures, payloads)
+        return payloads
+
     def __repr__(self):
         """Human-readable and machine-executable description of the current connection."""
-        return '{cls}(hostname={x._hostname!r}, port={x._port!r}, ssl={x._ssl!r}, verify={x._verify!r}, auth={x._authprovider!r})'.format(cls=self.__class__.__name__, x=self)
+        return '%s(hostname=%r, port=%r, ssl=%r, verify=%r, auth=%r)' % (
+            self.__class__.__name__, self._hostname, self._port, self._ssl, self._verify, self._authprovider)
 
     @property
     def server(self):
@@ -293,12 +499,17 @@ class Connection(object):
             if e.args[0] == 403:
                 raise AlreadyBootstrapped(e)
 
-        logging.info("Bootstrap has started, but it might take a while for server to start.")
+        logger.info("Bootstrap has started, but it might take a while for server to start.")
         self.wait_until_started()
 
     def wait_until_started(self):
+        # The server holds this request open until startup completes, so don't give up on reading the response.
+        # It can't log anyone in until then either, so don't send (and first obtain) an authorization header.
+        connect_timeout = self._timeout[0] if isinstance(self._timeout, tuple) else self._timeout
         self._call(
             method="POST",
-            url="/deployment/waitUntilStarted"
+            url="/deployment/waitUntilStarted",
+            sendauthorization=False,
+            timeout=(connect_timeout, None)
         )
-        logging.info("Server is started.")
+        logger.info("Server is started.")
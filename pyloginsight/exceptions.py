@@ -19,6 +19,16 @@ class Unauthorized(TransportError):
     """Credentials are invalid, expired, or not suitible for attempted operation."""
 
 
+class BatchRejected(TransportError):
+    """The server rejected some items sent in a batch; the others were accepted.
+    `failures` is a list of (item, exception) and `payloads` the responses to the accepted requests."""
+
+    def __init__(self, failures, payloads):
+        super(BatchRejected, self).__init__(failures, payloads)
+        self.failures = failures
+        self.payloads = payloads
+
+
 class Cancel(RuntimeError):
     """Update to server intentionally cancelled from within a context manager."""
 
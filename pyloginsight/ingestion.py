@@ -90,3 +90,17 @@ def transmit(connection, event_object, agent_id="1", trusted=False):
         return r.get("ingested", 0)
 
     raise ServerError(r)
+
+
+def transmit_many(connection, event_objects, agent_id="1", trusted=False, chunk_size=500):
+    """Transmit many Event objects to a remote Log Insight server, up to `chunk_size` per request.
+    Events the server rejects are raised together as :py:class:`BatchRejected`, after all the others have been sent."""
+
+    events = [serialize_event_object(event_object) for event_object in event_objects]
+
+    ingested = 0
+    for r in connection._post_batch("/events/ingest/" + agent_id, events, chunk_size=chunk_size, sendauthorization=trusted):
+        if r.get("status", None) != 'ok':
+            raise ServerError(r)
+        ingested += r.get("ingested", 0)
+    return ingested
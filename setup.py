@@ -67,6 +67,7 @@ setup(
     license='Apache Software License 2.0',
     author='Alan Castonguay',
     install_requires=runtime_requirements,
+    extras_require={'orjson': ['orjson>=3.4']},
     tests_require=runtime_requirements + ["requests_mock", "pytest", "pytest-catchlog", "pytest-flakes", "pytest-pep8"],
     description='VMware vRealize Log Insight Client',
     author_email='acastonguay@vmware.com',
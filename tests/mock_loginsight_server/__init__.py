@@ -56,9 +56,9 @@ class MockedConnection(Connection):
         # no outbound requests are made during init
         super(MockedConnection, self).__init__(*args, **kwargs)
 
-        # Mount the requests-mock-adapter
+        # Mount the requests-mock-adapter over the connection's own pooled adapter
         adapter = LogInsightMockAdapter()
-        self._requestsession.mount('https://', adapter)
+        self._requestsession.mount(self._apiroot, adapter)
 
 
 def mock_server_with_authenticated_connection():
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import pyloginsight.connection
+from pyloginsight.connection import Connection, Credentials
+from pyloginsight.exceptions import BatchRejected, TransportError
+from mock_loginsight_server import MockedConnection
+from requests.adapters import HTTPAdapter
+import requests
+import requests_mock
+import datetime
+import json
+import pytest
+
+
+def test_connection_mounts_pooled_adapter():
+    c = Connection("loginsight.example.com", pool_maxsize=4)
+    adapter = c._requestsession.get_adapter(c._apiroot + "/version")
+    assert isinstance(adapter, HTTPAdapter)
+    assert adapter._pool_maxsize == 4
+    assert adapter._pool_block
+
+
+def test_copy_connection_shares_session():
+    c = Connection("loginsight.example.com")
+    copy = Connection.copy_connection(c)
+    assert copy._requestsession is c._requestsession
+
+
+def test_url_is_absolute_and_cached():
+    c = Connection("loginsight.example.com", port=443)
+    assert c._url("/version") == "https://loginsight.example.com:443/api/v1/version"
+    assert c._url("/version") is c._url("/version")
+
+
+def test_copy_connection_keeps_timeout():
+    c = Connection("loginsight.example.com", timeout=(1, 2))
+    assert Connection.copy_connection(c)._timeout == (1, 2)
+
+
+def test_login_before_first_request(connection):
+    """A connection without a session logs in up-front, instead of waiting to be refused with 401."""
+    connection._authprovider.sessionId = None
+    r = connection._request("GET", "/sessions/current")
+    assert r.status_code == 200
+    assert r.history == []
+
+
+def test_login_again_before_session_expires(connection):
+    credentials = connection._authprovider
+    connection._request("GET", "/sessions/current")
+    expiring = credentials.sessionId
+    credentials._expires_at = 0
+
+    r = connection._request("GET", "/sessions/current")
+    assert r.status_code == 200
+    assert r.history == []
+    assert credentials.sessionId != expiring
+    assert credentials._expires_at > 0
+
+
+def test_401_retries_with_newer_session(connection):
+    """A request refused with an old session is retried with the current session, without logging in again."""
+    credentials = connection._authprovider
+    connection._request("GET", "/sessions/current")
+    current = credentials.sessionId
+
+    refused = connection._requestsession.get(connection._url("/sessions/current"), headers={"Authorization": "Bearer stale"})
+    assert refused.status_code == 401
+
+    r = credentials.handle_401(refused)
+    assert r.status_code == 200
+    assert credentials.sessionId == current
+
+
+def test_existing_session_auth_is_not_used():
+    session = requests.Session()
+    session.auth = ("user", "password")
+    c = Connection("loginsight.example.com", existing_session=session)
+    assert c._requestsession.auth is None
+
+
+def test_get_many(connection):
+    results = connection.get_many(["/version", "/sessions/current", "/version"])
+    assert len(results) == 3
+    assert results[0] == results[2] == connection.get("/version")
+    assert 'ttl' in results[1]
+
+
+def test_login_again_after_401(connection, monkeypatch):
+    """A session the server doesn't recognize is refused once, then replaced by logging in through the connection's session."""
+    credentials = connection._authprovider
+    credentials.sessionId = "stale"
+    credentials._expires_at = None
+
+    sent = []
+    send = connection._requestsession.send
+
+    def record(request, **kwargs):
+        sent.append((request.method, request.path_url))
+        return send(request, **kwargs)
+    monkeypatch.setattr(connection._requestsession, "send", record)
+
+    r = connection._request("GET", "/sessions/current")
+    assert r.status_code == 200
+    assert [h.status_code for h in r.history] == [401]
+    assert credentials.sessionId != "stale"
+    assert sent == [("GET", "/api/v1/sessions/current"), ("POST", "/api/v1/sessions")]
+
+
+def test_connections_to_same_server_share_pool():
+    a = Connection("loginsight.example.com")
+    b = Connection("loginsight.example.com")
+    other = Connection("other.example.com")
+    assert a._requestsession is not b._requestsession
+    assert a._requestsession.get_adapter(a._apiroot) is b._requestsession.get_adapter(b._apiroot)
+    assert a._requestsession.get_adapter(a._apiroot) is not other._requestsession.get_adapter(other._apiroot)
+
+
+def test_stream_response_body(connection):
+    r = connection._request("GET", "/version", stream=True)
+    try:
+        body = b"".join(r.iter_content(65536))
+    finally:
+        r.close()
+    assert json.loads(body.decode("utf-8")) == connection.get("/version")
+
+
+def test_credentials_shared_by_two_servers():
+    """One Credentials object logs in to whichever server each request goes to, not the last Connection built."""
+    credentials = Credentials("admin", "VMware123!", "Local")
+    a = MockedConnection("a.example.com", auth=credentials)
+    b = MockedConnection("b.example.com", auth=credentials)
+
+    assert 'ttl' in b.get("/sessions/current")
+    assert 'ttl' in a.get("/sessions/current")
+    assert 'ttl' in b.get("/sessions/current")
+
+    credentials.sessionId = None
+    r = a._request("GET", "/sessions/current")
+    assert r.status_code == 200
+    assert r.history == []
+
+
+def test_wait_until_started_does_not_log_in():
+    c = MockedConnection("mockserverlocal", auth=Credentials("admin", "VMware123!", "Local"))
+    c.wait_until_started()
+    history = c._requestsession.get_adapter(c._apiroot).request_history
+    assert [h.path for h in history] == ["/api/v1/deployment/waituntilstarted"]
+    assert 'Authorization' not in history[0].headers
+
+
+def test_post_batch_sends_every_item_when_one_is_rejected():
+    received = []
+
+    def ingest(request, context):
+        events = request.json()['events']
+        received.append(events)
+        if "bad" in events:
+            context.status_code = 400
+            return {'errorMessage': 'Rejected'}
+        return {'ingested': len(events)}
+
+    c = Connection("loginsight.example.com")
+    adapter = requests_mock.Adapter()
+    adapter.register_uri('POST', '/api/v1/events/ingest/1', json=ingest)
+    c._requestsession.mount(c._apiroot, adapter)
+
+    with pytest.raises(BatchRejected) as excinfo:
+        c._post_batch("/events/ingest/1", ["g0", "bad", "g1", "g2", "g3"], chunk_size=4)
+
+    assert received == [["g0", "bad", "g1", "g2"], ["g0"], ["bad"], ["g1"], ["g2"], ["g3"]]
+    assert [item for item, error in excinfo.value.failures] == ["bad"]
+    assert excinfo.value.payloads == [{'ingested': 1}] * 4
+
+
+@pytest.mark.parametrize("response", [
+    {'status_code': 503, 'json': {'errorMessage': 'Service unavailable'}},
+    {'exc': requests.exceptions.ReadTimeout},
+])
+def test_post_batch_raises_server_errors_without_splitting(response):
+    c = Connection("loginsight.example.com")
+    adapter = requests_mock.Adapter()
+    adapter.register_uri('POST', '/api/v1/events/ingest/1', **response)
+    c._requestsession.mount(c._apiroot, adapter)
+
+    with pytest.raises((ValueError, TransportError)) as excinfo:
+        c._post_batch("/events/ingest/1", ["g0", "g1", "g2", "g3", "g4"], chunk_size=4)
+
+    assert not isinstance(excinfo.value, BatchRejected)
+    assert adapter.call_count == 1
+
+
+def test_read_timeout_outlasts_server_timeout():
+    c = Connection("loginsight.example.com", timeout=(5, 60))
+    assert c._timeout_for(None) == (5, 60)
+    assert c._timeout_for({'timeout': 30000}) == (5, 60)
+    assert c._timeout_for({'timeout': 120000}) == (5, 150)
+
+
+def test_timeout_raises_transport_error():
+    c = Connection("loginsight.example.com")
+    adapter = requests_mock.Adapter()
+    adapter.register_uri('GET', '/api/v1/version', exc=requests.exceptions.ReadTimeout)
+    c._requestsession.mount(c._apiroot, adapter)
+
+    with pytest.raises(TransportError):
+        c.get("/version")
+
+
+class FakeOrjson(object):
+    """Stands in for orjson, which refuses dict keys that aren't str."""
+    OPT_PASSTHROUGH_DATETIME = 1
+    OPT_PASSTHROUGH_DATACLASS = 2
+
+    @staticmethod
+    def dumps(obj, option=None):
+        if any(not isinstance(k, str) for k in obj):
+            raise TypeError("Dict key must be str")
+        return json.dumps(obj).encode("utf-8")
+
+
+@pytest.mark.parametrize("orjson", [FakeOrjson, "orjson"])
+def test_json_body_serialized_with_orjson(monkeypatch, orjson):
+    if orjson == "orjson":
+        orjson = pytest.importorskip("orjson")
+    monkeypatch.setattr(pyloginsight.connection, "orjson", orjson)
+
+    c = Connection("loginsight.example.com")
+    adapter = requests_mock.Adapter()
+    adapter.register_uri('POST', '/api/v1/example', json={})
+    c._requestsession.mount(c._apiroot, adapter)
+
+    c.post("/example", json={"a": [1, "b"]})
+    assert isinstance(adapter.last_request.body, bytes)
+    assert json.loads(adapter.last_request.body.decode("utf-8")) == {"a": [1, "b"]}
+    assert adapter.last_request.headers['Content-Type'] == 'application/json'
+
+    # Falls back to requests' own serialization
+    c.post("/example", json={1: "a"})
+    assert json.loads(adapter.last_request.body.decode("utf-8")) == {"1": "a"}
+    assert adapter.last_request.headers['Content-Type'] == 'application/json'
+
+    # Refuses what requests would refuse without orjson
+    with pytest.raises(TypeError):
+        c.post("/example", json={"a": datetime.datetime(2017, 1, 1)})
+
+
+def test_close_keeps_shared_pool_open():
+    a = Connection("loginsight.example.com")
+    b = Connection("loginsight.example.com")
+    adapter = b._requestsession.get_adapter(b._apiroot)
+    adapter.poolmanager.connection_from_url(b._apiroot)
+    pools = len(adapter.poolmanager.pools)
+    assert pools > 0
+
+    a.close()
+    assert len(adapter.poolmanager.pools) == pools
+    assert b._requestsession.get_adapter(b._apiroot) is adapter
+
+
+def test_closing_a_copy_keeps_shared_pool_open():
+    a = Connection("loginsight.example.com")
+    b = Connection("loginsight.example.com")
+    adapter = b._requestsession.get_adapter(b._apiroot)
+    adapter.poolmanager.connection_from_url(b._apiroot)
+    pools = len(adapter.poolmanager.pools)
+
+    Connection.copy_connection(a).close()
+    assert len(adapter.poolmanager.pools) == pools
+
+
+def test_login_uses_connection_sessions_url(connection, monkeypatch):
+    """Neither an up-front login nor one after a 401 parses the request URL; the connection knows its /sessions URL."""
+    def urlparse(url):
+        raise AssertionError("urlparse(%r)" % url)
+    monkeypatch.setattr(pyloginsight.connection, "urlparse", urlparse)
+    credentials = connection._authprovider
+
+    credentials.sessionId = None
+    assert 'ttl' in connection.get("/sessions/current")
+
+    credentials.sessionId = "stale"
+    credentials._expires_at = None
+    assert 'ttl' in connection.get("/sessions/current")
@@ -9,7 +9,7 @@ from pyloginsight.exceptions import TransportError
 from pyloginsight.query import Constraint, Parameter
 from pyloginsight import operator
 from pyloginsight.models import Event
-from pyloginsight.ingestion import serialize_event_object, crush_invalid_field_name
+from pyloginsight.ingestion import serialize_event_object, crush_invalid_field_name, transmit_many
 from datetime import datetime
 import pytz
 import time
@@ -140,6 +140,12 @@ def test_ingest_single_empty_message(connection):
     connection.server.log(e)
 
 
+def test_ingest_many_messages(connection):
+    """Events are sent several per request, and every one of them is ingested."""
+    events = [Event(text=str(uuid.uuid4()), fields={'appname': 'pyloginsight test'}, timestamp=datetime.now(pytz.utc)) for _ in range(5)]
+    assert transmit_many(connection, events, chunk_size=2) == 5
+
+
 def test_ingest_pathalogical_field_name(connection):
     pathalogic = '''field @#$%^&/;\,.<a>'"value'''
     e = Event(